@@ -1,121 +1,787 @@
-from flask import Flask, request, jsonify
+from quart import Quart, request, jsonify
 import os
-import json
-from azure.storage.blob import BlobServiceClient
-from openai import AzureOpenAI
+import io
+import orjson
+import asyncio
+import hashlib
+import multiprocessing
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import aiohttp
+import httpx
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobServiceClient, ExponentialRetry
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient, BadRequestError, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from embedding_format import pack_embeddings
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, stop_before_delay, wait_random_exponential
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_METADATA_STORAGE_CONNECTION_STRING")
-blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
 
 METADATA_CONTAINER = "weez-files-metadata"
 EMBEDDINGS_CONTAINER = "weez-files-embeddings"
+EMBEDDINGS_CACHE_CONTAINER = "weez-embeddings-cache"
 
 AZURE_OPENAI_ENDPOINT = "https://weez-openai-resource.openai.azure.com/"
 AZURE_OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 AZURE_OPENAI_API_VERSION = "2024-12-01-preview"
 EMBEDDING_MODEL = "text-embedding-3-large"
+# text-embedding-3 models return a truncated, re-normalized vector when asked;
+# the stored header records the resulting dimension count
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1024"))
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_BATCH_MAX_TOKENS = 8191
+# A cached vector is a list of Python floats, ~32 bytes per dimension (~33 KB at 1024
+# dimensions); the default keeps the in-process tier around 25 MB per worker
+EMBEDDING_MEMORY_CACHE_SIZE = int(os.getenv("EMBEDDING_MEMORY_CACHE_SIZE", "768"))
 
-def fetch_user_blobs(container_client, user_id):
-    user_prefix = f"{user_id}/"
-    return container_client.list_blobs(name_starts_with=user_prefix)
+# Bulk runs go through the Batch API, which needs its own Global-Batch deployment.
+# Azure's batch paths drop OpenAI's /v1 prefix.
+BATCH_EMBEDDING_DEPLOYMENT = os.getenv("BATCH_EMBEDDING_DEPLOYMENT", EMBEDDING_MODEL)
+BATCH_EMBEDDINGS_URL = "/embeddings"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_SECONDS = 60
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# Azure's per-file limits for Batch API input
+BATCH_MAX_REQUESTS = 100_000
+BATCH_MAX_FILE_BYTES = 200 * 1024 * 1024
+# Batch manifests live next to the embeddings cache, outside its <model>-<dimensions>/ keys
+BATCH_MANIFEST_PREFIX = "batches/"
 
-def read_blob_content(container_client, blob_name):
-    blob_client = container_client.get_blob_client(blob_name)
-    return blob_client.download_blob().readall().decode('utf-8')
+# Maximum number of in-flight storage/OpenAI calls per request
+MAX_CONCURRENCY = int(os.getenv("EMBEDDINGS_MAX_CONCURRENCY", "16"))
+# Per-worker HTTP pool, shared by concurrent requests; keep it >= MAX_CONCURRENCY so
+# in-flight calls reuse keep-alive sockets instead of opening new TLS connections
+HTTP_POOL_SIZE = max(int(os.getenv("EMBEDDINGS_HTTP_POOL_SIZE", "64")), MAX_CONCURRENCY)
+HTTP_KEEPALIVE_SECONDS = 60
+BLOB_DOWNLOAD_CONCURRENCY = 8
+# 5000 is the service maximum per LIST response
+LIST_RESULTS_PER_PAGE = 5000
+PARALLEL_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+OPENAI_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+# Embedding calls back synchronous endpoints, and App Service's front end drops requests
+# after ~230s. No retry starts after OPENAI_RETRY_BUDGET_SECONDS, so one call is bounded
+# by that plus a single OPENAI_TIMEOUT (~180s).
+OPENAI_RETRY_ATTEMPTS = 5
+OPENAI_RETRY_BUDGET_SECONDS = 150
+# Upper bound on a server-requested Retry-After so one call can't stall a request indefinitely
+OPENAI_RETRY_AFTER_CAP = 20
+# The storage SDK retries 429/5xx itself. Its default ExponentialRetry waits 15s, 18s, 24s
+# (+/-3s) and stops after 3 retries, with status/connect/read errors each capped at 3 as
+# well. Request handlers want shorter waits and a little more headroom under throttling:
+# 1s, 3s, 5s, 9s, 17s (+/-1s), up to 5 retries for any of those error kinds.
+STORAGE_RETRY_ATTEMPTS = 5
+STORAGE_RETRY_POLICY = ExponentialRetry(
+    initial_backoff=1,
+    increment_base=2,
+    random_jitter_range=1,
+    retry_total=STORAGE_RETRY_ATTEMPTS,
+    retry_status=STORAGE_RETRY_ATTEMPTS,
+    retry_connect=STORAGE_RETRY_ATTEMPTS,
+    retry_read=STORAGE_RETRY_ATTEMPTS
+)
+# Very large runs can be split across processes so JSON decode/encode isn't held
+# to one core by the GIL; each shard opens its own clients and event loop
+SHARD_PROCESSES = int(os.getenv("EMBEDDINGS_SHARD_PROCESSES", "1"))
+SHARD_MIN_BLOBS = int(os.getenv("EMBEDDINGS_SHARD_MIN_BLOBS", "5000"))
 
-def compute_embeddings_with_azure_openai(metadata):
-    text = " ".join(str(value) for value in metadata.values())
-    client = AzureOpenAI(
+# Shared for the lifetime of the worker so connection pools survive across requests
+http_session = None
+blob_service_client = None
+openai_client = None
+embeddings_client = None
+metadata_container_client = None
+embeddings_container_client = None
+cache_container_client = None
+memory_cache = OrderedDict()
+process_pool = None
+
+@app.before_serving
+async def open_clients(ensure_containers=True):
+    global http_session, blob_service_client, openai_client, embeddings_client
+    global metadata_container_client, embeddings_container_client, cache_container_client
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE_SECONDS)
+    )
+    blob_service_client = BlobServiceClient.from_connection_string(
+        AZURE_STORAGE_CONNECTION_STRING,
+        transport=AioHttpTransport(session=http_session, session_owner=False),
+        retry_policy=STORAGE_RETRY_POLICY
+    )
+    metadata_container_client = blob_service_client.get_container_client(METADATA_CONTAINER)
+    embeddings_container_client = blob_service_client.get_container_client(EMBEDDINGS_CONTAINER)
+    cache_container_client = blob_service_client.get_container_client(EMBEDDINGS_CACHE_CONTAINER)
+    # Ensure output containers once per worker rather than probing them on every request
+    if ensure_containers:
+        for container_client in (embeddings_container_client, cache_container_client):
+            await ensure_container(container_client)
+    openai_client = AsyncAzureOpenAI(
         api_key=AZURE_OPENAI_API_KEY,
         api_version=AZURE_OPENAI_API_VERSION,
-        azure_endpoint=AZURE_OPENAI_ENDPOINT
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        timeout=OPENAI_TIMEOUT,
+        # HTTP/2 multiplexes concurrent embedding calls over a few long-lived TLS connections
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_POOL_SIZE,
+                keepalive_expiry=HTTP_KEEPALIVE_SECONDS
+            )
+        )
     )
-    response = client.embeddings.create(
+    # tenacity owns retries for embedding calls, so they go through a copy without the
+    # SDK's own retry loop; it shares the same httpx pool
+    embeddings_client = openai_client.with_options(max_retries=0)
+
+async def ensure_container(container_client):
+    try:
+        await container_client.create_container()
+    except ResourceExistsError:
+        pass
+    except HttpResponseError as e:
+        # Credentials scoped to blob read/write can't create containers (403). The container
+        # only has to exist, so boot anyway and let blob calls surface real problems.
+        try:
+            exists = await container_client.exists()
+        except HttpResponseError:
+            exists = None
+        if not exists:
+            app.logger.warning("Could not create or verify container %s: %s", container_client.container_name, e)
+
+@app.after_serving
+async def close_clients():
+    if process_pool is not None:
+        # Don't block the event loop on running shards past gunicorn's graceful_timeout
+        process_pool.shutdown(wait=False, cancel_futures=True)
+    await openai_client.close()
+    await blob_service_client.close()
+    await http_session.close()
+
+async def gather_limited(coros):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+def fetch_user_blobs(container_client, user_id):
+    user_prefix = f"{user_id}/"
+    return container_client.list_blobs(name_starts_with=user_prefix, results_per_page=LIST_RESULTS_PER_PAGE)
+
+async def read_blob_content(container_client, blob_name):
+    blob_client = container_client.get_blob_client(blob_name)
+    downloader = await blob_client.download_blob(max_concurrency=BLOB_DOWNLOAD_CONCURRENCY)
+    # Blobs up to max_single_get_size (32 MiB, i.e. every metadata blob) are already in
+    # memory after the first GET inside download_blob(), so readall() just returns them
+    if downloader.size <= PARALLEL_DOWNLOAD_THRESHOLD:
+        return await downloader.readall()
+    # readinto fetches the remaining ranges in parallel (max_concurrency)
+    stream = io.BytesIO()
+    await downloader.readinto(stream)
+    return stream.getbuffer()
+
+def metadata_to_text(metadata):
+    # Metadata values are nearly always strings, which join directly; anything
+    # else makes join raise and takes the str() path, giving the same text
+    try:
+        return " ".join(metadata.values())
+    except TypeError:
+        return " ".join(map(str, metadata.values()))
+
+def require_text(text):
+    # The embeddings API rejects empty input, and inside a batch that would fail every other blob
+    if not text.strip():
+        raise ValueError("Metadata has no text to embed")
+
+def estimate_tokens(text):
+    return len(text) // 4
+
+def iter_embedding_batches(items):
+    # items carry their flattened "text"; a batch is closed once it hits the
+    # input count or the estimated token budget for a single request
+    batch = []
+    batch_tokens = 0
+    for item in items:
+        tokens = estimate_tokens(item["text"])
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+wait_jittered = wait_random_exponential(min=1, max=30)
+
+def wait_retry_after(retry_state):
+    # Honour the delay Azure OpenAI asks for on 429s; fall back to jittered backoff
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    if response is not None:
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+            value = response.headers.get(header)
+            if value:
+                try:
+                    return min(float(value) * scale, OPENAI_RETRY_AFTER_CAP)
+                except ValueError:
+                    pass
+        # Retry-After may also be an HTTP-date
+        value = response.headers.get("retry-after")
+        if value:
+            try:
+                delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+                return min(max(delay, 0), OPENAI_RETRY_AFTER_CAP)
+            except (TypeError, ValueError):
+                pass
+    return wait_jittered(retry_state)
+
+@retry(
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(OPENAI_RETRY_ATTEMPTS) | stop_before_delay(OPENAI_RETRY_BUDGET_SECONDS),
+    reraise=True
+)
+async def compute_embeddings_batch(texts):
+    response = await embeddings_client.embeddings.create(
         model=EMBEDDING_MODEL,
-        input=text
+        input=texts,
+        dimensions=EMBEDDING_DIMENSIONS
     )
-    embeddings = response.data[0].embedding
+    # The API does not guarantee output order, so line results up by index
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def cache_key(content_hash):
+    # Model and dimensions are part of the key so changing either never serves stale vectors
+    return f"{EMBEDDING_MODEL}-{EMBEDDING_DIMENSIONS}/{content_hash}.json"
+
+def remember_embeddings(key, embeddings):
+    memory_cache[key] = embeddings
+    memory_cache.move_to_end(key)
+    if len(memory_cache) > EMBEDDING_MEMORY_CACHE_SIZE:
+        memory_cache.popitem(last=False)
+
+# The cache is best-effort: any read or write failure is treated as a miss
+async def read_cached_embeddings(cache_container_client, content_hash):
+    key = cache_key(content_hash)
+    if key in memory_cache:
+        memory_cache.move_to_end(key)
+        return memory_cache[key]
+    try:
+        embeddings = orjson.loads(await read_blob_content(cache_container_client, key))
+    except Exception:
+        return None
+    remember_embeddings(key, embeddings)
     return embeddings
 
-def upload_embeddings(blob_client, file_name, embeddings, file_path):
-    embeddings_data = {
-        "file_name": file_name,
-        "embeddings": embeddings,
-        "file_path": file_path
+async def write_cached_embeddings(cache_container_client, content_hash, embeddings):
+    key = cache_key(content_hash)
+    remember_embeddings(key, embeddings)
+    try:
+        await cache_container_client.get_blob_client(key).upload_blob(orjson.dumps(embeddings), overwrite=True)
+    except Exception:
+        pass
+
+async def get_embeddings(cache_container_client, text, content_hash):
+    embeddings = await read_cached_embeddings(cache_container_client, content_hash)
+    if embeddings is None:
+        embeddings = (await compute_embeddings_batch([text]))[0]
+        await write_cached_embeddings(cache_container_client, content_hash, embeddings)
+    return embeddings
+
+async def upload_embeddings(blob_client, file_name, embeddings, file_path, content_hash):
+    blob_metadata = {"contenthash": content_hash, "model": EMBEDDING_MODEL, "dimensions": str(EMBEDDING_DIMENSIONS)}
+    try:
+        properties = await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        properties = None
+    # Re-runs over unchanged metadata leave the existing blob untouched
+    if properties is not None and blob_metadata.items() <= properties.metadata.items():
+        return
+    await blob_client.upload_blob(
+        pack_embeddings(file_name, embeddings, file_path),
+        overwrite=True,
+        max_concurrency=1,
+        content_settings=ContentSettings(content_type="application/octet-stream"),
+        metadata=blob_metadata
+    )
+
+async def load_metadata(metadata_container_client, blob_name):
+    try:
+        metadata_content = await read_blob_content(metadata_container_client, blob_name)
+        metadata = orjson.loads(metadata_content)
+        file_path = metadata.get("file_path", "unknown_path")
+        text = metadata_to_text(metadata)
+        require_text(text)
+        return {"status": "loaded", "blob_name": blob_name, "file_path": file_path, "text": text, "content_hash": text_hash(text)}
+    except Exception as e:
+        return {"status": "failed", "blobremotename": blob_name, "error": str(e)}
+
+async def list_user_blob_names(user_id):
+    async for page in fetch_user_blobs(metadata_container_client, user_id).by_page():
+        async for blob in page:
+            yield blob.name
+
+async def iterate_blob_names(blob_names):
+    for blob_name in blob_names:
+        yield blob_name
+
+async def load_metadata_from(blob_names):
+    # Listing feeds a queue drained by MAX_CONCURRENCY downloaders, so the next
+    # LIST page is fetched while blobs from the previous one are being read
+    queue = asyncio.Queue()
+    results = []
+
+    async def produce():
+        try:
+            async for blob_name in blob_names:
+                queue.put_nowait(blob_name)
+        finally:
+            for _ in range(MAX_CONCURRENCY):
+                queue.put_nowait(None)
+
+    async def consume():
+        while True:
+            blob_name = await queue.get()
+            if blob_name is None:
+                return
+            results.append(await load_metadata(metadata_container_client, blob_name))
+
+    await asyncio.gather(produce(), *(consume() for _ in range(MAX_CONCURRENCY)))
+    return results
+
+async def load_user_metadata(user_id):
+    return await load_metadata_from(list_user_blob_names(user_id))
+
+def group_by_content(items):
+    groups = {}
+    for item in items:
+        groups.setdefault(item["content_hash"], []).append(item)
+    return groups
+
+def expand_to_group(result, group):
+    if result["status"] == "failed":
+        return [dict(item, status="failed", blobremotename=item["blob_name"], error=result["error"]) for item in group]
+    return [dict(item, status="embedded", embeddings=result["embeddings"]) for item in group]
+
+async def lookup_cached(cache_container_client, item):
+    embeddings = await read_cached_embeddings(cache_container_client, item["content_hash"])
+    if embeddings is None:
+        return item
+    return dict(item, status="embedded", embeddings=embeddings)
+
+async def embed_batch(cache_container_client, batch):
+    try:
+        embeddings_list = await compute_embeddings_batch([item["text"] for item in batch])
+    except BadRequestError as e:
+        if len(batch) > 1:
+            # One rejected input fails the whole request, so fall back to one call per
+            # item and only the offending blob ends up in failed_files. The calls run
+            # one after another to stay within this batch's concurrency slot.
+            results = []
+            for item in batch:
+                results.extend(await embed_batch(cache_container_client, [item]))
+            return results
+        return [dict(item, status="failed", blobremotename=item["blob_name"], error=str(e)) for item in batch]
+    except Exception as e:
+        return [dict(item, status="failed", blobremotename=item["blob_name"], error=str(e)) for item in batch]
+    await asyncio.gather(*(
+        write_cached_embeddings(cache_container_client, item["content_hash"], embeddings)
+        for item, embeddings in zip(batch, embeddings_list)
+    ))
+    return [dict(item, status="embedded", embeddings=embeddings) for item, embeddings in zip(batch, embeddings_list)]
+
+async def store_embeddings(embeddings_container_client, item):
+    try:
+        embeddings_blob_client = embeddings_container_client.get_blob_client(item["blob_name"])
+        await upload_embeddings(embeddings_blob_client, item["blob_name"], item["embeddings"], item["file_path"], item["content_hash"])
+        return {"status": "processed", "blob_name": item["blob_name"]}
+    except Exception as e:
+        return {"status": "failed", "blobremotename": item["blob_name"], "error": str(e)}
+
+def collect_failures(results, failed_files):
+    passed = []
+    for result in results:
+        if result["status"] == "failed":
+            failed_files.append({"blobremotename": result["blobremotename"], "error": result["error"]})
+        else:
+            passed.append(result)
+    return passed
+
+async def embed_and_store_groups(groups):
+    # groups maps content_hash to the loaded blobs sharing that flattened text; each
+    # group gets one cache lookup and one embedding
+    failed_files = []
+    looked_up = await gather_limited(lookup_cached(cache_container_client, group[0]) for group in groups.values())
+    misses = [item for item in looked_up if item["status"] == "loaded"]
+    batch_results = await gather_limited(embed_batch(cache_container_client, batch) for batch in iter_embedding_batches(misses))
+    resolved = [item for item in looked_up if item["status"] == "embedded"]
+    resolved.extend(result for results in batch_results for result in results)
+    embedded = collect_failures((item for result in resolved for item in expand_to_group(result, groups[result["content_hash"]])), failed_files)
+    stored = collect_failures(await gather_limited(store_embeddings(embeddings_container_client, item) for item in embedded), failed_files)
+    return {
+        "processed_files": [result["blob_name"] for result in stored],
+        "failed_files": failed_files
     }
-    embeddings_json = json.dumps(embeddings_data)
-    blob_client.upload_blob(embeddings_json, overwrite=True)
 
-def process_user_metadata_to_embeddings(user_id):
-    metadata_container_client = blob_service_client.get_container_client(METADATA_CONTAINER)
-    embeddings_container_client = blob_service_client.get_container_client(EMBEDDINGS_CONTAINER)
-    if not embeddings_container_client.exists():
-        blob_service_client.create_container(EMBEDDINGS_CONTAINER)
-    blobs = fetch_user_blobs(metadata_container_client, user_id)
+async def process_blob_names(blob_names):
+    failed_files = []
+    loaded = collect_failures(await load_metadata_from(blob_names), failed_files)
+    result = await embed_and_store_groups(group_by_content(loaded))
+    result["failed_files"] = failed_files + result["failed_files"]
+    return result
+
+def run_shard(shard_step, payload):
+    return asyncio.run(run_in_shard(shard_step, payload))
+
+async def run_in_shard(shard_step, payload):
+    # The parent worker has already ensured the output containers exist
+    await open_clients(ensure_containers=False)
+    try:
+        return await shard_step(payload)
+    finally:
+        await close_clients()
+
+async def load_shard(blob_names):
+    return await load_metadata_from(iterate_blob_names(blob_names))
+
+async def process_blob_shards(blob_names):
+    global process_pool
+    if process_pool is None:
+        # spawn rather than fork so shards never inherit the parent's live sockets
+        process_pool = ProcessPoolExecutor(max_workers=SHARD_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    loop = asyncio.get_running_loop()
+
+    async def run_shards(shard_step, shards):
+        return await asyncio.gather(*(
+            loop.run_in_executor(process_pool, run_shard, shard_step, shard) for shard in shards if shard
+        ))
+
+    # Shards download and parse the metadata, then the results are grouped here across
+    # the whole run and re-sharded by content hash, so duplicate texts that were listed
+    # into different shards are still embedded only once
+    failed_files = []
+    loaded_shards = await run_shards(load_shard, [blob_names[i::SHARD_PROCESSES] for i in range(SHARD_PROCESSES)])
+    loaded = collect_failures((result for results in loaded_shards for result in results), failed_files)
+    group_shards = [{} for _ in range(SHARD_PROCESSES)]
+    for content_hash, group in group_by_content(loaded).items():
+        group_shards[int(content_hash[:8], 16) % SHARD_PROCESSES][content_hash] = group
+    results = await run_shards(embed_and_store_groups, group_shards)
+    return {
+        "processed_files": [blob_name for result in results for blob_name in result["processed_files"]],
+        "failed_files": failed_files + [failure for result in results for failure in result["failed_files"]]
+    }
+
+async def process_user_metadata_to_embeddings(user_id):
+    blob_names = list_user_blob_names(user_id)
+    if SHARD_PROCESSES > 1:
+        # Splitting into shards needs the complete listing up front
+        listed = [blob_name async for blob_name in blob_names]
+        if len(listed) >= SHARD_MIN_BLOBS:
+            return await process_blob_shards(listed)
+        blob_names = iterate_blob_names(listed)
+    return await process_blob_names(blob_names)
+
+async def submit_embeddings_batch(user_id):
     processed_files = []
     failed_files = []
-    for blob in blobs:
+    loaded = []
+    for result in await load_user_metadata(user_id):
+        if result["status"] == "failed":
+            failed_files.append({"blobremotename": result["blobremotename"], "error": result["error"]})
+        else:
+            loaded.append(result)
+
+    # Cache hits don't need to wait for the batch, so store them straight away;
+    # only one request per distinct text goes into the batch
+    groups = group_by_content(loaded)
+    looked_up = await gather_limited(lookup_cached(cache_container_client, group[0]) for group in groups.values())
+    hits = [item for result in looked_up if result["status"] == "embedded" for item in expand_to_group(result, groups[result["content_hash"]])]
+    misses = [item for item in looked_up if item["status"] == "loaded"]
+    for result in await gather_limited(store_embeddings(embeddings_container_client, item) for item in hits):
+        if result["status"] == "failed":
+            failed_files.append({"blobremotename": result["blobremotename"], "error": result["error"]})
+        else:
+            processed_files.append(result["blob_name"])
+
+    batch_ids = []
+    submitted_files = []
+    for items, requests_jsonl in iter_batch_files(misses):
+        members = [member for item in items for member in groups[item["content_hash"]]]
         try:
-            metadata_content = read_blob_content(metadata_container_client, blob.name)
-            metadata = json.loads(metadata_content)
-            file_path = metadata.get("file_path", "unknown_path")
-            embeddings = compute_embeddings_with_azure_openai(metadata)
-            embeddings_blob_client = embeddings_container_client.get_blob_client(blob.name)
-            upload_embeddings(embeddings_blob_client, blob.name, embeddings, file_path)
-            processed_files.append(blob.name)
+            batch_id = await create_embeddings_batch(user_id, items, groups, requests_jsonl)
         except Exception as e:
-            failed_files.append({"blobremotename": blob.name, "error": str(e)})
+            failed_files.extend({"blobremotename": member["blob_name"], "error": str(e)} for member in members)
+            continue
+        batch_ids.append(batch_id)
+        submitted_files.extend(member["blob_name"] for member in members)
+        app.add_background_task(collect_embeddings_batch, batch_id)
     return {
+        "batch_ids": batch_ids,
+        "submitted_files": submitted_files,
         "processed_files": processed_files,
         "failed_files": failed_files
     }
 
+def iter_batch_files(items):
+    # Each Batch API input file is capped on request count and size, so large runs
+    # are split across several files (and therefore several batches)
+    chunk = []
+    lines = []
+    size = 0
+    for item in items:
+        line = orjson.dumps({
+            "custom_id": item["content_hash"],
+            "method": "POST",
+            "url": BATCH_EMBEDDINGS_URL,
+            "body": {"model": BATCH_EMBEDDING_DEPLOYMENT, "input": item["text"], "dimensions": EMBEDDING_DIMENSIONS}
+        }) + b"\n"
+        if chunk and (len(chunk) >= BATCH_MAX_REQUESTS or size + len(line) > BATCH_MAX_FILE_BYTES):
+            yield chunk, b"".join(lines)
+            chunk = []
+            lines = []
+            size = 0
+        chunk.append(item)
+        lines.append(line)
+        size += len(line)
+    if chunk:
+        yield chunk, b"".join(lines)
+
+def batch_manifest_name(batch_id):
+    return f"{BATCH_MANIFEST_PREFIX}{batch_id}.json"
+
+async def read_batch_manifest(batch_id):
+    return orjson.loads(await read_blob_content(cache_container_client, batch_manifest_name(batch_id)))
+
+async def write_batch_manifest(manifest):
+    blob_client = cache_container_client.get_blob_client(batch_manifest_name(manifest["batch_id"]))
+    await blob_client.upload_blob(orjson.dumps(manifest), overwrite=True)
+
+async def create_embeddings_batch(user_id, items, groups, requests_jsonl):
+    batch_file = await openai_client.files.create(file=("embeddings.jsonl", requests_jsonl), purpose="batch")
+    batch = await openai_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_EMBEDDINGS_URL,
+        completion_window=BATCH_COMPLETION_WINDOW
+    )
+    # The manifest is the only link from the batch's custom_ids back to blobs, and
+    # it outlives this worker so collection can be resumed after a restart
+    manifest = {
+        "batch_id": batch.id,
+        "user_id": user_id,
+        "state": "pending",
+        "entries": {
+            item["content_hash"]: [
+                {"blob_name": member["blob_name"], "file_path": member["file_path"]}
+                for member in groups[item["content_hash"]]
+            ]
+            for item in items
+        }
+    }
+    try:
+        await write_batch_manifest(manifest)
+    except Exception:
+        await openai_client.batches.cancel(batch.id)
+        raise
+    return batch.id
+
+async def poll_embeddings_batch(batch_id):
+    while True:
+        try:
+            batch = await openai_client.batches.retrieve(batch_id)
+            if batch.status in BATCH_TERMINAL_STATUSES:
+                return batch
+        except (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError):
+            pass  # transient; try again on the next poll
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+
+def batch_record_error(record):
+    response = record.get("response") or {}
+    error = record.get("error") or (response.get("body") or {}).get("error") or {}
+    return error.get("message") or f"Batch request failed with status {response.get('status_code')}"
+
+async def finish_embeddings_batch(manifest, batch):
+    # Safe to run more than once, including concurrently from different gunicorn workers:
+    # cache entries are rewritten with the same vectors, store_embeddings skips blobs whose
+    # content hash already matches, and every run writes the same collected manifest
+    embeddings_by_hash = {}
+    errors_by_hash = {}
+    # Expired or cancelled batches can still carry partial output, so read both files
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        output = await openai_client.files.content(file_id)
+        for line in (await output.aread()).splitlines():
+            record = orjson.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200:
+                embeddings_by_hash[record["custom_id"]] = response["body"]["data"][0]["embedding"]
+            else:
+                errors_by_hash[record["custom_id"]] = batch_record_error(record)
+
+    missing_error = f"No result returned; batch ended with status '{batch.status}'"
+    if batch.errors and batch.errors.data:
+        missing_error += ": " + "; ".join(error.message or error.code or "unknown error" for error in batch.errors.data)
+    embedded = []
+    failed_files = []
+    for content_hash, members in manifest["entries"].items():
+        embeddings = embeddings_by_hash.get(content_hash)
+        if embeddings is None:
+            error = errors_by_hash.get(content_hash, missing_error)
+            failed_files.extend({"blobremotename": member["blob_name"], "error": error} for member in members)
+            continue
+        embedded.extend(dict(member, content_hash=content_hash, embeddings=embeddings) for member in members)
+    await gather_limited(
+        write_cached_embeddings(cache_container_client, content_hash, embeddings)
+        for content_hash, embeddings in embeddings_by_hash.items()
+    )
+    processed_files = []
+    for result in await gather_limited(store_embeddings(embeddings_container_client, item) for item in embedded):
+        if result["status"] == "failed":
+            failed_files.append({"blobremotename": result["blobremotename"], "error": result["error"]})
+        else:
+            processed_files.append(result["blob_name"])
+
+    manifest.pop("last_error", None)
+    manifest.update(
+        state="collected",
+        batch_status=batch.status,
+        processed_files=processed_files,
+        failed_files=failed_files
+    )
+    await write_batch_manifest(manifest)
+    return manifest
+
+async def collect_embeddings_batch(batch_id):
+    try:
+        batch = await poll_embeddings_batch(batch_id)
+        await finish_embeddings_batch(await read_batch_manifest(batch_id), batch)
+    except Exception as e:
+        # The manifest stays pending, so POST .../collect can pick the batch up again
+        try:
+            manifest = await read_batch_manifest(batch_id)
+            manifest["last_error"] = str(e)
+            await write_batch_manifest(manifest)
+        except Exception:
+            pass
+
+def batch_manifest_result(manifest):
+    return {
+        "batch_id": manifest["batch_id"],
+        "state": manifest["state"],
+        "batch_status": manifest["batch_status"],
+        "processed_files": manifest["processed_files"],
+        "failed_files": manifest["failed_files"]
+    }
+
 @app.route('/process_embeddings', methods=['POST'])
-def process_embeddings():
-    data = request.get_json()
+async def process_embeddings():
+    data = await request.get_json()
     user_id = data.get('user_id')
     if not user_id:
         return jsonify({"error": "Missing user_id in request"}), 400
     try:
-        result = process_user_metadata_to_embeddings(user_id)
+        result = await process_user_metadata_to_embeddings(user_id)
         return jsonify({"message": "Processing completed", "result": result}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/process_embeddings_batch', methods=['POST'])
+async def process_embeddings_batch():
+    data = await request.get_json()
+    user_id = data.get('user_id')
+    if not user_id:
+        return jsonify({"error": "Missing user_id in request"}), 400
+    try:
+        result = await submit_embeddings_batch(user_id)
+        return jsonify({"message": "Batch submitted", "result": result}), 202
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/process_embeddings_batch/<batch_id>', methods=['GET'])
+async def embeddings_batch_status(batch_id):
+    try:
+        manifest = await read_batch_manifest(batch_id)
+    except ResourceNotFoundError:
+        return jsonify({"error": f"Unknown batch {batch_id}"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    # Only a collected manifest means the embeddings were actually written
+    if manifest["state"] == "collected":
+        return jsonify(batch_manifest_result(manifest)), 200
+    try:
+        batch = await openai_client.batches.retrieve(batch_id)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    counts = batch.request_counts
+    return jsonify({
+        "batch_id": batch.id,
+        "state": manifest["state"],
+        "batch_status": batch.status,
+        "last_error": manifest.get("last_error"),
+        "completed": counts.completed if counts else 0,
+        "failed": counts.failed if counts else 0,
+        "total": counts.total if counts else 0
+    }), 200
+
+@app.route('/process_embeddings_batch/<batch_id>/collect', methods=['POST'])
+async def collect_embeddings_batch_results(batch_id):
+    try:
+        manifest = await read_batch_manifest(batch_id)
+    except ResourceNotFoundError:
+        return jsonify({"error": f"Unknown batch {batch_id}"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if manifest["state"] == "collected":
+        return jsonify(batch_manifest_result(manifest)), 200
+    try:
+        batch = await openai_client.batches.retrieve(batch_id)
+        if batch.status not in BATCH_TERMINAL_STATUSES:
+            return jsonify({"error": "Batch is still running", "batch_status": batch.status}), 409
+        manifest = await finish_embeddings_batch(manifest, batch)
+        return jsonify(batch_manifest_result(manifest)), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/process_single_embedding', methods=['POST'])
-def process_single_embedding():
-    data = request.get_json()
+async def process_single_embedding():
+    data = await request.get_json()
     user_id = data.get('user_id')
     blob_name = data.get('blob_name')
     if not user_id or not blob_name:
         return jsonify({"error": "Missing user_id or blob_name in request"}), 400
     
-    metadata_container_client = blob_service_client.get_container_client(METADATA_CONTAINER)
-    embeddings_container_client = blob_service_client.get_container_client(EMBEDDINGS_CONTAINER)
-    
-    if not embeddings_container_client.exists():
-        blob_service_client.create_container(EMBEDDINGS_CONTAINER)
-    
     try:
         # Ensure blob_name has the proper user_id prefix if not provided
         if not blob_name.startswith(f"{user_id}/"):
             blob_name = f"{user_id}/{blob_name}"
         
         # Read metadata
-        metadata_content = read_blob_content(metadata_container_client, blob_name)
-        metadata = json.loads(metadata_content)
+        metadata_content = await read_blob_content(metadata_container_client, blob_name)
+        metadata = orjson.loads(metadata_content)
         
         # Extract file path
         file_path = metadata.get("file_path", "unknown_path")
         
         # Compute embeddings
-        embeddings = compute_embeddings_with_azure_openai(metadata)
+        text = metadata_to_text(metadata)
+        require_text(text)
+        content_hash = text_hash(text)
+        embeddings = await get_embeddings(cache_container_client, text, content_hash)
         
         # Upload embeddings
         embeddings_blob_client = embeddings_container_client.get_blob_client(blob_name)
-        upload_embeddings(embeddings_blob_client, blob_name, embeddings, file_path)
+        await upload_embeddings(embeddings_blob_client, blob_name, embeddings, file_path, content_hash)
         
         return jsonify({
             "status": "success",
@@ -130,4 +796,4 @@ def process_single_embedding():
         }), 500
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)  # Changed port to avoid conflict with generateMetadata.py
+    app.run(port=5000)  # Local development only; production runs under gunicorn. Changed port to avoid conflict with generateMetadata.py
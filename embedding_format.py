@@ -0,0 +1,30 @@
+# Binary layout of the blobs written to the embeddings container. Readers of
+# that container should use unpack_embeddings (or reimplement it from this):
+#
+#   <u32 little-endian header length N>
+#   <N bytes of UTF-8 JSON header: file_name, file_path, dtype, dimensions>
+#   <dimensions * itemsize bytes of the vector, in the header's numpy dtype>
+#
+# Vectors are stored as little-endian float16; unit-length embeddings lose well
+# under 1e-3 cosine similarity at this precision.
+import struct
+import orjson
+import numpy as np
+
+EMBEDDING_STORAGE_DTYPE = "<f2"
+
+def pack_embeddings(file_name, embeddings, file_path):
+    vector = np.asarray(embeddings, dtype=EMBEDDING_STORAGE_DTYPE)
+    header = orjson.dumps({
+        "file_name": file_name,
+        "file_path": file_path,
+        "dtype": EMBEDDING_STORAGE_DTYPE,
+        "dimensions": len(vector)
+    })
+    return struct.pack('<I', len(header)) + header + vector.tobytes()
+
+def unpack_embeddings(data):
+    (header_length,) = struct.unpack_from('<I', data)
+    header = orjson.loads(data[4:4 + header_length])
+    vector = np.frombuffer(data, dtype=header["dtype"], offset=4 + header_length)
+    return header, vector
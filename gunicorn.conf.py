@@ -0,0 +1,10 @@
+# Picked up automatically by `gunicorn app:app`; the Quart app is ASGI, so it
+# needs an ASGI worker instead of gunicorn's default sync worker. Each worker
+# runs one event loop that keeps many Azure/OpenAI calls in flight at once.
+import os
+
+worker_class = "uvicorn_worker.UvicornWorker"
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
@@ -0,0 +1,176 @@
+import asyncio
+from types import SimpleNamespace
+
+import orjson
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+import app
+
+
+class FakeBlobClient:
+    def __init__(self, blobs, blob_name):
+        self.blobs = blobs
+        self.blob_name = blob_name
+
+    async def upload_blob(self, data, overwrite=False):
+        self.blobs[self.blob_name] = bytes(data)
+
+
+class FakeContainerClient:
+    def __init__(self):
+        self.blobs = {}
+
+    def get_blob_client(self, blob_name):
+        return FakeBlobClient(self.blobs, blob_name)
+
+
+class FakeFiles:
+    def __init__(self):
+        self.contents = {}
+
+    async def create(self, file, purpose):
+        file_id = f"file-{len(self.contents)}"
+        self.contents[file_id] = file[1]
+        return SimpleNamespace(id=file_id)
+
+    async def content(self, file_id):
+        async def aread():
+            return self.contents[file_id]
+        return SimpleNamespace(aread=aread)
+
+
+class FakeBatches:
+    def __init__(self):
+        self.batches = {}
+        self.retrieved = []
+
+    async def retrieve(self, batch_id):
+        self.retrieved.append(batch_id)
+        return self.batches[batch_id]
+
+    async def cancel(self, batch_id):
+        pass
+
+
+def output_line(custom_id, status_code, body):
+    return orjson.dumps({"custom_id": custom_id, "response": {"status_code": status_code, "body": body}})
+
+
+@pytest.fixture
+def fake_batch_api(monkeypatch):
+    cache = FakeContainerClient()
+    files = FakeFiles()
+    batches = FakeBatches()
+    uploaded = {}
+    cached = {}
+
+    async def read_blob_content(container_client, blob_name):
+        if blob_name not in container_client.blobs:
+            raise ResourceNotFoundError("missing")
+        return container_client.blobs[blob_name]
+
+    async def write_cached(cache_container_client, content_hash, embeddings):
+        cached[content_hash] = embeddings
+
+    async def upload(blob_client, file_name, embeddings, file_path, content_hash):
+        uploaded[file_name] = embeddings
+
+    monkeypatch.setattr(app, "openai_client", SimpleNamespace(files=files, batches=batches))
+    monkeypatch.setattr(app, "cache_container_client", cache)
+    monkeypatch.setattr(app, "embeddings_container_client", FakeContainerClient())
+    monkeypatch.setattr(app, "read_blob_content", read_blob_content)
+    monkeypatch.setattr(app, "write_cached_embeddings", write_cached)
+    monkeypatch.setattr(app, "upload_embeddings", upload)
+    return SimpleNamespace(cache=cache, files=files, batches=batches, uploaded=uploaded, cached=cached)
+
+
+def make_item(text):
+    return {"status": "loaded", "blob_name": text, "file_path": text, "text": text, "content_hash": app.text_hash(text)}
+
+
+def pending_manifest(batch_id, entries):
+    return {
+        "batch_id": batch_id,
+        "user_id": "u",
+        "state": "pending",
+        "entries": {
+            content_hash: [{"blob_name": name, "file_path": name} for name in names]
+            for content_hash, names in entries.items()
+        }
+    }
+
+
+def test_batch_files_split_at_request_count(monkeypatch):
+    monkeypatch.setattr(app, "BATCH_MAX_REQUESTS", 2)
+    items = [make_item(f"text {i}") for i in range(5)]
+    files = list(app.iter_batch_files(items))
+    assert [len(chunk) for chunk, _ in files] == [2, 2, 1]
+    for chunk, requests_jsonl in files:
+        lines = [orjson.loads(line) for line in requests_jsonl.splitlines()]
+        assert [line["custom_id"] for line in lines] == [item["content_hash"] for item in chunk]
+        assert [line["body"]["input"] for line in lines] == [item["text"] for item in chunk]
+
+
+def test_batch_files_split_at_byte_limit(monkeypatch):
+    items = [make_item(f"text {i}") for i in range(5)]
+    line_size = len(next(app.iter_batch_files(items[:1]))[1])
+    monkeypatch.setattr(app, "BATCH_MAX_FILE_BYTES", line_size * 2)
+    files = list(app.iter_batch_files(items))
+    assert [len(chunk) for chunk, _ in files] == [2, 2, 1]
+    assert all(len(requests_jsonl) <= line_size * 2 for _, requests_jsonl in files)
+
+
+def test_oversized_request_still_gets_a_file(monkeypatch):
+    monkeypatch.setattr(app, "BATCH_MAX_FILE_BYTES", 10)
+    items = [make_item("first"), make_item("second")]
+    assert [len(chunk) for chunk, _ in app.iter_batch_files(items)] == [1, 1]
+
+
+def test_finish_maps_records_to_processed_and_failed(fake_batch_api):
+    ok, rejected, missing = (app.text_hash(text) for text in ("ok", "rejected", "missing"))
+    fake_batch_api.files.contents["out"] = output_line(ok, 200, {"data": [{"embedding": [0.5, 0.25]}]})
+    fake_batch_api.files.contents["err"] = output_line(rejected, 400, {"error": {"message": "input too long"}})
+    batch = SimpleNamespace(
+        status="expired",
+        output_file_id="out",
+        error_file_id="err",
+        errors=SimpleNamespace(data=[SimpleNamespace(message=None, code=None)])
+    )
+    manifest = pending_manifest("batch-1", {ok: ["a", "a-copy"], rejected: ["b"], missing: ["c"]})
+
+    result = asyncio.run(app.finish_embeddings_batch(manifest, batch))
+
+    assert sorted(result["processed_files"]) == ["a", "a-copy"]
+    assert fake_batch_api.uploaded == {"a": [0.5, 0.25], "a-copy": [0.5, 0.25]}
+    assert fake_batch_api.cached == {ok: [0.5, 0.25]}
+    errors = {failure["blobremotename"]: failure["error"] for failure in result["failed_files"]}
+    assert errors["b"] == "input too long"
+    assert errors["c"] == "No result returned; batch ended with status 'expired': unknown error"
+    stored = orjson.loads(fake_batch_api.cache.blobs[app.batch_manifest_name("batch-1")])
+    assert stored["state"] == "collected"
+    assert stored["batch_status"] == "expired"
+
+
+def test_collect_endpoint_returns_stored_result_for_collected_batch(fake_batch_api):
+    manifest = pending_manifest("batch-2", {})
+    manifest.update(state="collected", batch_status="completed", processed_files=["a"], failed_files=[])
+    fake_batch_api.cache.blobs[app.batch_manifest_name("batch-2")] = orjson.dumps(manifest)
+
+    async def collect():
+        response = await app.app.test_client().post("/process_embeddings_batch/batch-2/collect")
+        return response.status_code, await response.get_json()
+
+    status_code, body = asyncio.run(collect())
+    assert status_code == 200
+    assert body == {"batch_id": "batch-2", "state": "collected", "batch_status": "completed", "processed_files": ["a"], "failed_files": []}
+    assert fake_batch_api.batches.retrieved == []
+    assert fake_batch_api.uploaded == {}
+
+
+def test_collect_endpoint_unknown_batch(fake_batch_api):
+    async def collect():
+        response = await app.app.test_client().post("/process_embeddings_batch/nope/collect")
+        return response.status_code
+
+    assert asyncio.run(collect()) == 404
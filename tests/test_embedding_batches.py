@@ -0,0 +1,89 @@
+import asyncio
+
+import httpx
+from openai import BadRequestError
+
+import app
+
+
+def make_item(name, text):
+    return {"status": "loaded", "blob_name": name, "file_path": name, "text": text, "content_hash": app.text_hash(text)}
+
+
+def test_batches_close_at_input_count(monkeypatch):
+    monkeypatch.setattr(app, "EMBEDDING_BATCH_SIZE", 3)
+    items = [make_item(f"b{i}", "word") for i in range(7)]
+    batches = list(app.iter_embedding_batches(items))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [item for batch in batches for item in batch] == items
+
+
+def test_batches_close_at_token_budget(monkeypatch):
+    monkeypatch.setattr(app, "EMBEDDING_BATCH_MAX_TOKENS", 10)
+    # 16 characters estimate to 4 tokens, so only two fit under the budget
+    items = [make_item(f"b{i}", "x" * 16) for i in range(5)]
+    assert [len(batch) for batch in app.iter_embedding_batches(items)] == [2, 2, 1]
+
+
+def test_oversized_item_gets_its_own_batch(monkeypatch):
+    monkeypatch.setattr(app, "EMBEDDING_BATCH_MAX_TOKENS", 10)
+    items = [make_item("small", "x" * 8), make_item("huge", "x" * 400), make_item("after", "x" * 8)]
+    assert [[item["blob_name"] for item in batch] for batch in app.iter_embedding_batches(items)] == [["small"], ["huge"], ["after"]]
+
+
+def test_empty_input_yields_nothing():
+    assert list(app.iter_embedding_batches([])) == []
+
+
+def test_bad_request_falls_back_to_one_call_per_item(monkeypatch):
+    calls = []
+    in_flight = 0
+    peak = 0
+
+    async def compute(texts):
+        nonlocal in_flight, peak
+        calls.append(texts)
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0)
+        in_flight -= 1
+        if "bad" in texts:
+            response = httpx.Response(400, request=httpx.Request("POST", "https://example.invalid"))
+            raise BadRequestError("invalid input", response=response, body=None)
+        return [[float(len(text))] for text in texts]
+
+    async def write_cached(*args):
+        pass
+
+    monkeypatch.setattr(app, "compute_embeddings_batch", compute)
+    monkeypatch.setattr(app, "write_cached_embeddings", write_cached)
+    batch = [make_item("a", "good"), make_item("b", "bad"), make_item("c", "fine")]
+    results = asyncio.run(app.embed_batch(None, batch))
+
+    assert calls == [["good", "bad", "fine"], ["good"], ["bad"], ["fine"]]
+    assert peak == 1
+    assert [(result["blob_name"], result["status"]) for result in results] == [("a", "embedded"), ("b", "failed"), ("c", "embedded")]
+    assert results[0]["embeddings"] == [4.0]
+    assert results[1]["blobremotename"] == "b" and results[1]["error"] == "invalid input"
+
+
+def test_other_errors_fail_the_batch_without_fallback(monkeypatch):
+    calls = []
+
+    async def compute(texts):
+        calls.append(texts)
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(app, "compute_embeddings_batch", compute)
+    results = asyncio.run(app.embed_batch(None, [make_item("a", "one"), make_item("b", "two")]))
+    assert calls == [["one", "two"]]
+    assert [result["status"] for result in results] == ["failed", "failed"]
+
+
+def test_blank_metadata_is_rejected_before_batching(monkeypatch):
+    async def read_blob_content(container_client, blob_name):
+        return b'{"title": " ", "tags": ""}'
+
+    monkeypatch.setattr(app, "read_blob_content", read_blob_content)
+    result = asyncio.run(app.load_metadata(None, "u/blank.json"))
+    assert result == {"status": "failed", "blobremotename": "u/blank.json", "error": "Metadata has no text to embed"}
@@ -0,0 +1,37 @@
+import numpy as np
+
+from embedding_format import EMBEDDING_STORAGE_DTYPE, pack_embeddings, unpack_embeddings
+
+
+def make_embedding(dimensions, seed=0):
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def test_round_trip_header():
+    data = pack_embeddings("user/file.json", make_embedding(1024), "docs/file.pdf")
+    header, vector = unpack_embeddings(data)
+    assert header == {
+        "file_name": "user/file.json",
+        "file_path": "docs/file.pdf",
+        "dtype": EMBEDDING_STORAGE_DTYPE,
+        "dimensions": 1024
+    }
+    assert vector.dtype == np.dtype(EMBEDDING_STORAGE_DTYPE)
+    assert vector.shape == (1024,)
+
+
+def test_round_trip_within_fp16_tolerance():
+    embeddings = make_embedding(3072)
+    _, vector = unpack_embeddings(pack_embeddings("a", embeddings, "b"))
+    original = np.asarray(embeddings)
+    restored = vector.astype(np.float64)
+    np.testing.assert_allclose(restored, original, atol=1e-3)
+    cosine = restored @ original / (np.linalg.norm(restored) * np.linalg.norm(original))
+    assert cosine > 1 - 1e-4
+
+
+def test_size_is_header_plus_two_bytes_per_dimension():
+    data = pack_embeddings("a", make_embedding(1024), "b")
+    header_length = int.from_bytes(data[:4], "little")
+    assert len(data) == 4 + header_length + 2 * 1024
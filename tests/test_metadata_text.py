@@ -0,0 +1,19 @@
+from app import metadata_to_text
+
+
+def baseline(metadata):
+    return " ".join(str(value) for value in metadata.values())
+
+
+def test_string_values_join_directly():
+    metadata = {"file_name": "report.pdf", "file_path": "docs/report.pdf", "summary": ""}
+    assert metadata_to_text(metadata) == baseline(metadata) == "report.pdf docs/report.pdf "
+
+
+def test_mixed_values_match_str_join():
+    metadata = {"title": "x", "pages": 3, "tags": ["a", "b"], "extra": {"k": 1}, "score": 1.5, "owner": None}
+    assert metadata_to_text(metadata) == baseline(metadata)
+
+
+def test_empty_metadata():
+    assert metadata_to_text({}) == ""
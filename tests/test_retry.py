@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import httpx
+
+import app
+
+
+def retry_state(headers=None):
+    error = Exception()
+    if headers is not None:
+        error.response = SimpleNamespace(headers=httpx.Headers(headers))
+    outcome = SimpleNamespace(exception=lambda: error)
+    return SimpleNamespace(outcome=outcome, attempt_number=1)
+
+
+def test_retry_after_ms_is_preferred():
+    assert app.wait_retry_after(retry_state({"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+
+
+def test_retry_after_seconds():
+    assert app.wait_retry_after(retry_state({"retry-after": "7"})) == 7
+
+
+def test_retry_after_is_capped():
+    assert app.wait_retry_after(retry_state({"retry-after": "600"})) == app.OPENAI_RETRY_AFTER_CAP
+
+
+def test_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=10)
+    delay = app.wait_retry_after(retry_state({"retry-after": format_datetime(when, usegmt=True)}))
+    assert 8 <= delay <= 10
+
+
+def test_retry_after_http_date_in_the_past():
+    when = datetime.now(timezone.utc) - timedelta(seconds=30)
+    assert app.wait_retry_after(retry_state({"retry-after": format_datetime(when, usegmt=True)})) == 0
+
+
+def test_missing_or_invalid_header_falls_back_to_jitter():
+    for state in (retry_state(), retry_state({}), retry_state({"retry-after": "soon"})):
+        assert 0 <= app.wait_retry_after(state) <= 30
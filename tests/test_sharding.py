@@ -0,0 +1,85 @@
+import asyncio
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+import app
+
+
+class FakeContainerClient:
+    def get_blob_client(self, blob_name):
+        return blob_name
+
+
+@pytest.fixture
+def fake_pipeline(monkeypatch):
+    metadata = {f"u/{i}.json": orjson.dumps({"text": f"text {i % 3}"}) for i in range(9)}
+    metadata["u/broken.json"] = b"{"
+    state = {"computed": [], "uploaded": {}, "opened": []}
+    lock = threading.Lock()
+
+    async def read_blob_content(container_client, blob_name):
+        if blob_name not in metadata:
+            raise ResourceNotFoundError("missing")
+        return metadata[blob_name]
+
+    async def compute(texts):
+        with lock:
+            state["computed"].extend(texts)
+        return [[float(len(text))] for text in texts]
+
+    async def write_cached(*args):
+        pass
+
+    async def upload(blob_client, file_name, embeddings, file_path, content_hash):
+        with lock:
+            state["uploaded"][file_name] = embeddings
+
+    async def open_clients(ensure_containers=True):
+        with lock:
+            state["opened"].append(ensure_containers)
+
+    async def close_clients():
+        pass
+
+    monkeypatch.setattr(app, "read_blob_content", read_blob_content)
+    monkeypatch.setattr(app, "compute_embeddings_batch", compute)
+    monkeypatch.setattr(app, "write_cached_embeddings", write_cached)
+    monkeypatch.setattr(app, "upload_embeddings", upload)
+    monkeypatch.setattr(app, "open_clients", open_clients)
+    monkeypatch.setattr(app, "close_clients", close_clients)
+    monkeypatch.setattr(app, "memory_cache", OrderedDict())
+    monkeypatch.setattr(app, "embeddings_container_client", FakeContainerClient())
+    monkeypatch.setattr(app, "SHARD_PROCESSES", 3)
+    # Threads stand in for the spawned processes; the shard entry points are the same
+    executor = ThreadPoolExecutor(max_workers=3)
+    monkeypatch.setattr(app, "process_pool", executor)
+    yield sorted(metadata), state
+    executor.shutdown()
+
+
+def test_shards_merge_results_and_dedupe_across_shards(fake_pipeline):
+    blob_names, state = fake_pipeline
+    result = asyncio.run(app.process_blob_shards(blob_names))
+
+    assert sorted(result["processed_files"]) == [name for name in blob_names if name != "u/broken.json"]
+    assert [failure["blobremotename"] for failure in result["failed_files"]] == ["u/broken.json"]
+    # Nine blobs share three distinct texts, spread over every listing shard
+    assert sorted(state["computed"]) == ["text 0", "text 1", "text 2"]
+    assert state["uploaded"]["u/3.json"] == state["uploaded"]["u/6.json"] == [6.0]
+
+
+def test_shards_skip_container_creation(fake_pipeline):
+    blob_names, state = fake_pipeline
+    asyncio.run(app.process_blob_shards(blob_names))
+    assert state["opened"] and not any(state["opened"])
+
+
+def test_shard_steps_are_picklable():
+    for shard_step in (app.load_shard, app.embed_and_store_groups):
+        assert pickle.loads(pickle.dumps(shard_step)) is shard_step
@@ -0,0 +1,43 @@
+import asyncio
+
+from azure.core.exceptions import HttpResponseError, ResourceExistsError
+
+import app
+
+
+class FakeContainerClient:
+    container_name = "weez-files-embeddings"
+
+    def __init__(self, create_error=None, exists=True, exists_error=None):
+        self.create_error = create_error
+        self.exists_result = exists
+        self.exists_error = exists_error
+        self.exists_calls = 0
+
+    async def create_container(self):
+        if self.create_error:
+            raise self.create_error
+
+    async def exists(self):
+        self.exists_calls += 1
+        if self.exists_error:
+            raise self.exists_error
+        return self.exists_result
+
+
+def test_existing_container_is_not_probed():
+    container_client = FakeContainerClient(create_error=ResourceExistsError("exists"))
+    asyncio.run(app.ensure_container(container_client))
+    assert container_client.exists_calls == 0
+
+
+def test_forbidden_create_falls_back_to_exists():
+    container_client = FakeContainerClient(create_error=HttpResponseError("forbidden"))
+    asyncio.run(app.ensure_container(container_client))
+    assert container_client.exists_calls == 1
+
+
+def test_unverifiable_container_does_not_block_startup():
+    container_client = FakeContainerClient(create_error=HttpResponseError("forbidden"), exists_error=HttpResponseError("forbidden"))
+    asyncio.run(app.ensure_container(container_client))
+    assert container_client.exists_calls == 1